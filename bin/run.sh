@@ -6,6 +6,13 @@ source $GIT_ROOT/config.rc || exit 1
 _responses=$SCRATCH/var/responses
 _questions=$SCRATCH/var/questions
 _results=$SCRATCH/opt
+_listing=$SCRATCH/var/listing
+_manifest=$SCRATCH/var/manifest.db
+_partitions=$SCRATCH/var/partitions
+_build=$SCRATCH/var/build
+_model=${STAN_MODEL:-model}
+_threads=$(( `nproc` / ${STAN_WORKERS:-1} ))
+[ $_threads -gt 0 ] || _threads=1
 
 while getopts 's:h' option; do
     case $option in
@@ -33,67 +40,69 @@ huggingface-cli login --token $HF_BEARER_TOKEN &> /dev/null || exit 1
 case $_step in
     1) # Hugging Face download
 	src=$GIT_ROOT/src/data
-	python $src/list_.py \
-	    | python $src/gather_.py \
-	    | python $src/reduce_.py --corpus $_responses \
-	    | python $src/download_.py \
-		     --output $_responses \
-		     --question-bank $_questions
+	python $src/pipeline_.py \
+	       --listing-cache $_listing \
+	       --manifest $_manifest \
+	       --output $_responses \
+	       --question-bank $_questions
 	;;
     2) # Stan preparation
 	src=$GIT_ROOT/src/model
-	tmp=`mktemp`
+	experiments=`mktemp`
 	script=aggregate-data
+	case $_model in
+	    model-binomial) extra=--compress ;;
+	    model-parallel) extra="--threads $_threads" ;;
+	esac
 
 	for i in $GIT_ROOT/src/experiments/*.py; do
-	    python $i --output $_results \
-		| while read; do
-		echo "[ `date` ] $REPLY" 1>&2
-		out=`dirname $REPLY`
+	    python $i --output $_results
+	done > $experiments
 
-		agg=$out/${script}.csv
-		python $src/${script}.py \
-		       --data-root $_responses \
-		       --question-bank $_questions \
-		       --experiment $REPLY > $agg
+	echo "[ `date` ] $script" 1>&2
+	python $src/${script}.py \
+	       --data-root $_responses \
+	       --question-bank $_questions \
+	       --partitions $_partitions \
+	       --output ${script}.csv \
+	       `sed -e's/^/--experiment /' $experiments` || exit 1
 
-		python $src/build-ids.py < $agg > $tmp
-		for j in stan variables; do
-		    cat <<EOF
-python $src/to-${j}.py --data-file $tmp > $out/$j.json
-EOF
-		done | parallel --will-cite --line-buffer
+	while read; do
+	    echo "[ `date` ] $REPLY" 1>&2
+	    out=`dirname $REPLY`
+
+	    agg=$out/${script}.csv
+	    python $src/prepare-data.py \
+		   --data-file $agg \
+		   --ids $out/ids.json \
+		   --stan $out/stan.json \
+		   --variables $out/variables.json \
+		   --npz $out/data.npz \
+		   $extra || exit 1
 
-		pigz --best $agg
-	    done
-	done
+	    pigz --best $agg
+	done < $experiments
 
-	rm $tmp
+	rm $experiments
 	;;
     3) # Stan sampling
 	src=$GIT_ROOT/src/model
-	for d in $SCRATCH/opt/*; do
-	    echo "[ START `date` ] $d" 1>&2
-
-	    output=$d/output
-	    summary=$d/summary.csv
-	    mkdir $output 2> /dev/null || rm --recursive --force $output/*
-	    rm --force $summary
-
-	    (cd $CMDSTAN && make --jobs=`nproc` $src/model) || exit 1
-	    $src/model \
-		sample \
-		num_samples=$STAN_SAMPLES \
-		num_warmup=$STAN_WARMUP \
-		num_chains=$STAN_WORKERS \
-		data \
-		file=$d/stan.json \
-		output \
-		file=$output/chain.csv \
-		num_threads=$STAN_WORKERS \
-		&& stansummary --csv_filename=$summary $output/*.csv
+	threads=1
+	if [ $_model = model-parallel ]; then
+	    threads=$_threads
+	fi
 
-	done
+	python $src/sample-chains.py \
+	       --experiments $_results \
+	       --model $src/${_model}.stan \
+	       --build-cache $_build \
+	       --cmdstan $CMDSTAN \
+	       --chains $STAN_WORKERS \
+	       --samples $STAN_SAMPLES \
+	       --warmup $STAN_WARMUP \
+	       ${STAN_SEGMENT:+--segment $STAN_SEGMENT} \
+	       ${STAN_REFIT:+--refit} \
+	       --threads-per-chain $threads || exit 1
 	;;
     4) # Hugging Face upload
 	for i in $SCRATCH/opt/*; do
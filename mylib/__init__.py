@@ -6,3 +6,10 @@ from ._utils import (
     SubmissionInfo,
 )
 from ._logger import Logger
+from ._limiter import RateLimiter
+from ._ids import VariableIds
+from ._bank import QuestionBank
+from ._corpus import CorpusFormat
+from ._shared import SharedFrame
+from ._manifest import CorpusManifest
+from ._convergence import Convergence
@@ -0,0 +1,138 @@
+import os
+import json
+import fcntl
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import asdict
+
+from ._logger import Logger
+
+#
+# Question bank shards (one JSONL per benchmark/subject) with a SQLite
+# sidecar mapping question hash to byte offset. Writers to the same
+# shard serialise on a lock on the JSONL; writers to different shards
+# run independently. The sidecar records how far into the JSONL it has
+# indexed, so lines appended without an index (older banks, or a crash
+# between write and commit) are picked up on next open; a trailing
+# partial line is truncated.
+#
+class QuestionBank:
+    def __init__(self, root, timeout=60):
+        self.root = root
+        self.timeout = timeout
+
+    def to_path(self, name):
+        return self.root.joinpath(name).with_suffix('.jsonl')
+
+    def write(self, name, documents):
+        written = 0
+        with self.shard(name) as (fp, con):
+            for d in documents:
+                if self.contains(con, d.question):
+                    continue
+                offset = fp.tell()
+                fp.write(self.dumps(d))
+                con.execute(
+                    'INSERT INTO question VALUES (?, ?)',
+                    (d.question, offset),
+                )
+                written += 1
+            fp.flush()
+            self.mark(con, fp.tell())
+
+        return written
+
+    def missing(self, name, documents):
+        index = self.to_path(name).with_suffix('.sqlite')
+        if not index.exists():
+            yield from documents
+            return
+
+        uri = f'{index.absolute().as_uri()}?mode=ro'
+        con = sqlite3.connect(uri, uri=True, timeout=self.timeout)
+        try:
+            row = con.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'question'",
+            ).fetchone()
+            for d in documents:
+                if row is None or not self.contains(con, d.question):
+                    yield d
+        finally:
+            con.close()
+
+    @contextmanager
+    def shard(self, name):
+        path = self.to_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        with path.open('ab') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            con = sqlite3.connect(path.with_suffix('.sqlite'), timeout=self.timeout)
+            try:
+                with con:
+                    self.setup(con)
+                    end = self.catchup(con, path)
+                    # the position was fixed when the file was opened,
+                    # before the lock; other writers may have appended
+                    # since, and truncate() does not move it either
+                    if fp.seek(0, os.SEEK_END) > end:
+                        Logger.warning('%s: truncating partial line', path)
+                        fp.truncate(end)
+                    fp.seek(end)
+                    yield (fp, con)
+            finally:
+                con.close()
+
+    def setup(self, con):
+        con.execute('''
+        CREATE TABLE IF NOT EXISTS question (
+          hash TEXT PRIMARY KEY,
+          offset INTEGER NOT NULL
+        )''')
+        con.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+          key TEXT PRIMARY KEY,
+          value INTEGER NOT NULL
+        )''')
+
+    def catchup(self, con, path):
+        row = con.execute("SELECT value FROM meta WHERE key = 'end'").fetchone()
+        end = 0 if row is None else row[0]
+
+        with path.open('rb') as fp:
+            fp.seek(end)
+            while True:
+                offset = fp.tell()
+                line = fp.readline()
+                if not line.endswith(b'\n'):
+                    break
+                question = json.loads(line)['question']
+                if not self.contains(con, question):
+                    con.execute(
+                        'INSERT INTO question VALUES (?, ?)',
+                        (question, offset),
+                    )
+                end = fp.tell()
+        self.mark(con, end)
+
+        return end
+
+    @staticmethod
+    def contains(con, question):
+        row = con.execute(
+            'SELECT 1 FROM question WHERE hash = ?',
+            (question, ),
+        ).fetchone()
+        return row is not None
+
+    @staticmethod
+    def mark(con, end):
+        con.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('end', ?)",
+            (end, ),
+        )
+
+    @staticmethod
+    def dumps(document):
+        line = json.dumps(asdict(document)) + '\n'
+        return line.encode()
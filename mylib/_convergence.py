@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+
+import numpy as np
+from scipy.stats import rankdata
+from scipy.special import ndtri
+
+#
+# Rank-normalised split R-hat and bulk/tail effective sample size
+# (Vehtari et al., 2021). Draws are arrays of shape (chains, draws,
+# parameters); every statistic is computed per parameter.
+#
+def split(x):
+    n = x.shape[1] // 2
+    return np.concatenate((x[:, :n], x[:, -n:]))
+
+def normalise(x):
+    (m, n, p) = x.shape
+    ranks = rankdata(x.reshape(m * n, p), axis=0)
+    return ndtri((ranks - 3 / 8) / (m * n + 1 / 4)).reshape(x.shape)
+
+def rhat(x):
+    n = x.shape[1]
+    W = x.var(axis=1, ddof=1).mean(axis=0)
+    B = n * x.mean(axis=1).var(axis=0, ddof=1)
+
+    return np.sqrt(((n - 1) / n * W + B / n) / W)
+
+def ess(x):
+    (m, n, _) = x.shape
+
+    # per-chain autocovariance by FFT
+    size = 1 << (2 * n - 1).bit_length()
+    centred = x - x.mean(axis=1, keepdims=True)
+    f = np.fft.rfft(centred, n=size, axis=1)
+    acov = np.fft.irfft(f * np.conj(f), n=size, axis=1)[:, :n] / n
+
+    W = acov[:, 0].mean(axis=0) * n / (n - 1)
+    var_plus = W * (n - 1) / n
+    if m > 1:
+        var_plus += x.mean(axis=1).var(axis=0, ddof=1)
+    rho = 1 - (W - acov.mean(axis=0)) / var_plus
+    rho[0] = 1
+
+    # Geyer's initial monotone sequence over paired autocorrelations
+    k = n // 2
+    pairs = rho[:2 * k:2] + rho[1:2 * k:2]
+    pairs = np.where(np.cumprod(pairs > 0, axis=0), pairs, 0)
+    pairs = np.minimum.accumulate(pairs, axis=0)
+    tau = np.maximum(2 * pairs.sum(axis=0) - 1, 1 / np.log10(m * n))
+
+    return m * n / tau
+
+def tail(x):
+    (lower, upper) = np.quantile(x, (0.05, 0.95), axis=(0, 1))
+    return np.minimum(ess(split(x <= lower)), ess(split(x <= upper)))
+
+@dataclass(frozen=True)
+class Convergence:
+    rhat: float = 1.01
+    ess_bulk: float = 400
+    ess_tail: float = 400
+    block: int = 1024
+
+    def __call__(self, draws):
+        return self.met(self.measure(draws))
+
+    def met(self, measured):
+        return all((
+            measured['rhat'] <= self.rhat,
+            measured['ess_bulk'] >= self.ess_bulk,
+            measured['ess_tail'] >= self.ess_tail,
+        ))
+
+    # worst case over all parameters, a block of columns at a time to
+    # bound the size of the temporaries
+    def measure(self, draws):
+        (r, bulk, tails) = ([], [], [])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(0, draws.shape[-1], self.block):
+                x = draws[..., i:i + self.block].astype(float)
+                z = split(normalise(x))
+                median = np.median(x, axis=(0, 1))
+                folded = split(normalise(np.abs(x - median)))
+
+                r.append(np.maximum(rhat(z), rhat(folded)))
+                bulk.append(ess(z))
+                tails.append(tail(x))
+
+        return {
+            'rhat': float(np.nanmax(np.concatenate(r))),
+            'ess_bulk': float(np.nanmin(np.concatenate(bulk))),
+            'ess_tail': float(np.nanmin(np.concatenate(tails))),
+        }
@@ -0,0 +1,173 @@
+import csv
+import gzip
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ._logger import Logger
+
+#
+# Writers accept a submission one DataFrame batch at a time. The target
+# is created on the first non-empty batch, so a submission without rows
+# leaves nothing on disk.
+#
+class CorpusWriter:
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.fp = None
+
+    def __call__(self, df):
+        if df.empty:
+            return
+
+        if self.fp is None:
+            self.fp = self.open(df)
+        self.write(df)
+        self.rows += len(df)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+    def open(self, df):
+        raise NotImplementedError()
+
+    def write(self, df):
+        raise NotImplementedError()
+
+class CsvWriter(CorpusWriter):
+    def open(self, df):
+        return gzip.open(self.path, mode='wt', newline='')
+
+    def write(self, df):
+        df.to_csv(self.fp, header=not self.rows, index=False)
+
+#
+# Strings are dictionary encoded (and come back as categoricals). The
+# schema is fixed by the first batch so that every row group agrees.
+#
+class ParquetWriter(CorpusWriter):
+    def open(self, df):
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        fields = []
+        for f in schema:
+            if pa.types.is_string(f.type) or pa.types.is_large_string(f.type):
+                f = f.with_type(pa.dictionary(pa.int32(), pa.string()))
+            fields.append(f)
+        self.schema = pa.schema(fields, metadata=schema.metadata)
+
+        return pq.ParquetWriter(self.path, self.schema, compression='zstd')
+
+    def write(self, df):
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self.fp.write_table(table)
+
+#
+#
+#
+class CorpusFormat:
+    suffix = None
+    _Writer = None
+
+    @staticmethod
+    def from_name(name):
+        return _formats[name]()
+
+    @staticmethod
+    def from_path(path):
+        for f in _formats.values():
+            if path.name.endswith(f.suffix):
+                return f()
+        raise ValueError(path)
+
+    @staticmethod
+    def glob(root):
+        for f in _formats.values():
+            yield from root.rglob(f'*{f.suffix}')
+
+    @contextmanager
+    def writer(self, path):
+        tmp = path.with_name(f'.{path.name}.tmp')
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+
+        writer = self._Writer(tmp)
+        try:
+            yield writer
+            writer.close()
+            if writer.rows:
+                tmp.replace(path)
+                self.prune(path)
+        finally:
+            writer.close()
+            tmp.unlink(missing_ok=True)
+
+    # the same submission written earlier in another format; glob
+    # would otherwise yield both and its observations would count twice
+    def prune(self, path):
+        stem = path.name.removesuffix(self.suffix)
+        for f in _formats.values():
+            if f.suffix != self.suffix:
+                sibling = path.with_name(f'{stem}{f.suffix}')
+                if sibling.exists():
+                    Logger.info('%s: replaced by %s', sibling, path.name)
+                    sibling.unlink()
+
+    def write(self, df, path):
+        with self.writer(path) as writer:
+            writer(df)
+
+    def head(self, path, columns=None):
+        raise NotImplementedError()
+
+    def read(self, path, columns=None, metrics=None):
+        raise NotImplementedError()
+
+class CsvFormat(CorpusFormat):
+    suffix = '.csv.gz'
+    _Writer = CsvWriter
+
+    def head(self, path, columns=None):
+        with gzip.open(path, mode='rt') as fp:
+            reader = csv.DictReader(fp)
+            for row in reader:
+                return row
+
+    def read(self, path, columns=None, metrics=None):
+        df = pd.read_csv(
+            path,
+            usecols=columns,
+            compression='gzip',
+            memory_map=True,
+        )
+        if metrics is not None:
+            df = df[df['metric'].isin(metrics)]
+
+        return df
+
+#
+# Filters on `metric` are pushed down to the row groups.
+#
+class ParquetFormat(CorpusFormat):
+    suffix = '.parquet'
+    _Writer = ParquetWriter
+
+    def head(self, path, columns=None):
+        pf = pq.ParquetFile(path)
+        for batch in pf.iter_batches(batch_size=1, columns=columns):
+            for row in batch.to_pylist():
+                return row
+
+    def read(self, path, columns=None, metrics=None):
+        filters = None
+        if metrics is not None:
+            filters = [('metric', 'in', list(metrics))]
+
+        return pd.read_parquet(path, columns=columns, filters=filters)
+
+_formats = {
+    'csv': CsvFormat,
+    'parquet': ParquetFormat,
+}
@@ -0,0 +1,96 @@
+import json
+
+import pandas as pd
+
+from ._logger import Logger
+
+#
+# IDs are positions (1-based) in an index of known values. Values not
+# yet in the index are appended in order of first appearance, so with a
+# persisted index existing items and models keep their IDs across runs.
+#
+class VariableIndex:
+    def __init__(self, known):
+        self.index = self.to_index(known)
+
+    def __call__(self, df):
+        values = self.extract(df)
+        codes = self.index.get_indexer(values)
+
+        new = codes < 0
+        if new.any():
+            (_, uniques) = pd.factorize(values[new])
+            Logger.info('%s: %d new', type(self).__name__, len(uniques))
+            self.index = self.index.append(uniques)
+            codes = self.index.get_indexer(values)
+
+        return codes + 1
+
+    def __len__(self):
+        return len(self.index)
+
+    def to_list(self):
+        return self.index.tolist()
+
+    def extract(self, df):
+        raise NotImplementedError()
+
+    def to_index(self, known):
+        raise NotImplementedError()
+
+class AuthorModelIndex(VariableIndex):
+    _keys = [
+        'author',
+        'model',
+    ]
+
+    def extract(self, df):
+        return pd.MultiIndex.from_frame(df[self._keys])
+
+    def to_index(self, known):
+        if not known:
+            known = [ [] for _ in self._keys ]
+            return pd.MultiIndex.from_arrays(known, names=self._keys)
+        return pd.MultiIndex.from_tuples(map(tuple, known), names=self._keys)
+
+class DocumentIndex(VariableIndex):
+    def extract(self, df):
+        return pd.Index(df['document'])
+
+    def to_index(self, known):
+        return pd.Index(known, dtype=object)
+
+#
+#
+#
+class VariableIds:
+    _indexes = {
+        'document_id': DocumentIndex,
+        'author_model_id': AuthorModelIndex,
+    }
+
+    def __init__(self, path=None):
+        self.path = path
+
+        known = {}
+        if self.path is not None and self.path.exists():
+            known = json.loads(self.path.read_text())
+        self.indexes = {
+            x: y(known.get(x, [])) for (x, y) in self._indexes.items()
+        }
+
+    def __call__(self, df):
+        assert not any(x in df.columns for x in self.indexes)
+        return df.assign(**{ x: y(df) for (x, y) in self.indexes.items() })
+
+    def __getitem__(self, key):
+        return self.indexes[key]
+
+    def save(self):
+        if self.path is None:
+            return
+
+        ids = { x: y.to_list() for (x, y) in self.indexes.items() }
+        tmp = self.path.with_name(f'.{self.path.name}')
+        tmp.write_text(json.dumps(ids))
+        tmp.replace(self.path)
@@ -0,0 +1,109 @@
+import time
+import multiprocessing as mp
+from contextlib import contextmanager
+
+from ._logger import Logger
+
+#
+# Token bucket shared by every process that inherits it (pass it to
+# Pool workers through initargs). The refill rate and the number of
+# requests allowed in flight both follow AIMD: each success adds a
+# little, each throttled response (429 or 5xx) halves them and drains
+# the bucket, so all workers back off together and then climb back
+# towards the ceiling. A throttling episode cuts only once: requests
+# already in flight when a cut happens, and any throttled response
+# within `cooldown` seconds of it, do not cut again.
+#
+class RateLimiter:
+    _fields = (
+        'tokens',
+        'stamp',
+        'rate',
+        'limit',
+        'active',
+        'cut',
+    )
+    _poll = 0.05
+
+    def __init__(self, rate, ceiling=None, concurrency=1, max_concurrency=None,
+                 increase=0.5, decrease=0.5, floor=0.1, cooldown=1):
+        self.ceiling = rate if ceiling is None else ceiling
+        self.max_concurrency = concurrency if max_concurrency is None else max_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.floor = floor
+        self.cooldown = cooldown
+
+        self.lock = mp.Lock()
+        self.state = mp.RawArray('d', len(self._fields))
+        self.update(
+            tokens=1,
+            stamp=time.monotonic(),
+            rate=rate,
+            limit=concurrency,
+            active=0,
+            cut=0,
+        )
+
+    @contextmanager
+    def __call__(self):
+        started = self.acquire()
+        try:
+            yield
+        except Exception as err:
+            self.release(started, False, self.throttled(err))
+            raise
+        else:
+            self.release(started, True)
+
+    def get(self):
+        return dict(zip(self._fields, self.state))
+
+    def update(self, **kwargs):
+        for (k, v) in kwargs.items():
+            self.state[self._fields.index(k)] = v
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                s = self.get()
+                now = time.monotonic()
+                burst = max(1, s['rate'])
+                tokens = min(burst, s['tokens'] + s['rate'] * (now - s['stamp']))
+                self.update(tokens=tokens, stamp=now)
+
+                if tokens >= 1 and s['active'] < s['limit']:
+                    self.update(tokens=tokens - 1, active=s['active'] + 1)
+                    return now
+                wait = self._poll
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / s['rate'])
+            time.sleep(wait)
+
+    def release(self, started, success, throttled=False):
+        with self.lock:
+            s = self.get()
+            if throttled:
+                now = time.monotonic()
+                if started >= s['cut'] and now >= s['cut'] + self.cooldown:
+                    rate = max(self.floor, s['rate'] * self.decrease)
+                    limit = max(1, s['limit'] * self.decrease)
+                    self.update(rate=rate, limit=limit, cut=now)
+                    Logger.warning('throttled: rate=%.2f/s limit=%.1f', rate, limit)
+                self.update(tokens=min(0, s['tokens']))
+            elif success:
+                rate = min(self.ceiling, s['rate'] + self.increase)
+                limit = min(self.max_concurrency, s['limit'] + 1 / s['limit'])
+                self.update(rate=rate, limit=limit)
+            self.update(active=s['active'] - 1)
+
+    @staticmethod
+    def throttled(err):
+        while err is not None:
+            response = getattr(err, 'response', None)
+            status = getattr(response, 'status_code', None)
+            if status is not None:
+                return status == 429 or status >= 500
+            err = err.__cause__
+
+        return False
@@ -0,0 +1,56 @@
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import fields, astuple
+
+from ._utils import SubmissionInfo
+
+class CorpusManifest:
+    _table = 'submission'
+    _keys = tuple(x.name for x in fields(SubmissionInfo))
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+        columns = ', '.join(f'{x} TEXT NOT NULL' for x in self._keys)
+        primary = ', '.join(self._keys)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self._table} (
+              {columns},
+              date TEXT NOT NULL,
+              PRIMARY KEY ({primary})
+            )''')
+
+    def __iter__(self):
+        keys = ', '.join(self._keys)
+        with self.connect() as con:
+            for (*info, date) in con.execute(
+                    f'SELECT {keys}, date FROM {self._table}'
+            ):
+                yield (SubmissionInfo(*info), date)
+
+    @contextmanager
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def update(self, info, date):
+        self.extend([(info, date)])
+
+    def extend(self, entries, clear=False):
+        placeholders = ', '.join('?' * (len(self._keys) + 1))
+        rows = ((*astuple(i), str(d)) for (i, d) in entries)
+        with self.connect() as con:
+            if clear:
+                con.execute(f'DELETE FROM {self._table}')
+            con.executemany(
+                f'INSERT OR REPLACE INTO {self._table} VALUES ({placeholders})',
+                rows,
+            )
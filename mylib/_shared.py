@@ -0,0 +1,49 @@
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import pyarrow as pa
+
+#
+# A DataFrame handed between processes as an Arrow IPC stream in a
+# shared memory block: only the block's name crosses the queue. The
+# receiver copies the stream out in one piece and unlinks the block.
+#
+@dataclass(frozen=True)
+class SharedFrame:
+    name: str
+    size: int
+
+    @classmethod
+    def from_frame(cls, df):
+        batch = pa.RecordBatch.from_pandas(df, preserve_index=False)
+
+        sink = pa.MockOutputStream()
+        cls.dump(sink, batch)
+        size = sink.size()
+
+        shm = SharedMemory(create=True, size=size)
+        buf = pa.py_buffer(shm.buf)
+        cls.dump(pa.FixedSizeBufferWriter(buf), batch)
+        del buf
+        shm.close()
+        # the receiver owns (and unlinks) the block from here on
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+        return cls(shm.name, size)
+
+    @staticmethod
+    def dump(sink, batch):
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+
+    def to_frame(self):
+        shm = SharedMemory(self.name)
+        try:
+            data = bytes(shm.buf[:self.size])
+        finally:
+            shm.close()
+            shm.unlink()
+
+        with pa.ipc.open_stream(data) as reader:
+            return reader.read_pandas()
@@ -32,7 +32,7 @@ class SubmissionInfo:
 
     @classmethod
     def from_path(cls, path):
-        (model, _) = path.stem.split('.', maxsplit=1)
+        (model, *_) = path.stem.split('.', maxsplit=1)
         return cls(*path.parent.parts, model)
 
 @dataclass
@@ -0,0 +1,92 @@
+import sys
+import csv
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from argparse import ArgumentParser
+
+from fsspec.implementations.memory import MemoryFileSystem
+
+from mylib import Logger, Backoff
+from list_ import DatasetFileSystem, earliest
+
+#
+# In-memory stand-in for HfFileSystem: same URL scheme, same `ls`
+# entries (including `last_commit`), and a configurable per-call
+# latency to mimic Hub round trips.
+#
+class MemoryHubFileSystem(MemoryFileSystem):
+    protocol = ('hf',)
+    root_marker = ''
+    store = {}
+    pseudo_dirs = ['']
+    latency = 0
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        path = str(path)
+        (*_, path) = path.split('://', maxsplit=1)
+        return path.strip('/')
+
+    def ls(self, path, detail=True, **kwargs):
+        time.sleep(self.latency)
+
+        entries = super().ls(path, detail=True, **kwargs)
+        for i in entries:
+            if i['type'] == 'file':
+                date = datetime.fromtimestamp(i['created'], tz=timezone.utc)
+                i['last_commit'] = SimpleNamespace(date=date)
+
+        return entries if detail else [ x['name'] for x in entries ]
+
+def populate(fs, args):
+    for i in range(args.datasets):
+        dataset = Path('datasets', args.author, f'author__model-{i}-details')
+        for j in range(args.runs):
+            run = dataset.joinpath(f'author__model-{i}-{j}')
+            for k in range(args.files):
+                for day in range(1, 3):
+                    name = f'samples_leaderboard_bench-{k}_2024-01-{day:02d}.jsonl'
+                    fs.pipe(str(run.joinpath(name)), b'')
+
+        yield dataset.relative_to('datasets')
+
+#
+#
+#
+if __name__ == '__main__':
+    arguments = ArgumentParser()
+    arguments.add_argument('--author', default='open-llm-leaderboard')
+    arguments.add_argument('--datasets', type=int, default=10)
+    arguments.add_argument('--runs', type=int, default=4)
+    arguments.add_argument('--files', type=int, default=40)
+    arguments.add_argument('--latency', type=float, default=0.1)
+    arguments.add_argument('--in-flight', type=int, action='append')
+    args = arguments.parse_args()
+
+    fs = MemoryHubFileSystem()
+    fs.latency = args.latency
+    datasets = list(populate(fs, args))
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=[
+        'in_flight',
+        'seconds',
+        'results',
+    ])
+    writer.writeheader()
+
+    for n in args.in_flight or [1]:
+        walker = DatasetFileSystem(Backoff(1), n, fs)
+        start = time.perf_counter()
+        results = 0
+        for d in datasets:
+            results += len(earliest(walker.walk(d)))
+        seconds = time.perf_counter() - start
+        Logger.info('in_flight=%d %.2fs', n, seconds)
+
+        writer.writerow({
+            'in_flight': n,
+            'seconds': round(seconds, 3),
+            'results': results,
+        })
@@ -1,14 +1,18 @@
+import os
 import sys
 import csv
 import json
+import time
+import fcntl
 import itertools as it
 import functools as ft
 import statistics as st
 import collections as cl
 from typing import SupportsFloat
 from pathlib import Path
+from contextlib import nullcontext
 from argparse import ArgumentParser
-from dataclasses import dataclass, field, fields, asdict, replace
+from dataclasses import dataclass, field, fields, replace
 from urllib.parse import ParseResult, urlunparse
 from multiprocessing import Pool, Queue
 
@@ -18,7 +22,28 @@ import pandas as pd
 from requests import HTTPError
 from huggingface_hub.utils import GatedRepoError, build_hf_headers
 
-from mylib import Logger, DatasetPathHandler, SubmissionInfo, Document
+from mylib import (
+    Logger,
+    Backoff,
+    Document,
+    RateLimiter,
+    QuestionBank,
+    CorpusFormat,
+    CorpusManifest,
+    SubmissionInfo,
+    DatasetPathHandler,
+)
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+def loads(line):
+    try:
+        return _loads(line)
+    except ValueError: # orjson rejects NaN/Infinity
+        return json.loads(line)
 
 #
 # Types and functions to evaluation scores. Create new `to_float`s to
@@ -56,34 +81,6 @@ class DocumentBank:
     def __iter__(self):
         yield from self.documents
 
-class DocumentAggregator:
-    def __init__(self, destination):
-        self.destination = destination
-        self.history = cl.defaultdict(set)
-
-    def __call__(self, dbank):
-        output = (self
-                  .destination
-                  .joinpath(dbank.name)
-                  .with_suffix('.jsonl'))
-        history = self.setup_and_load(output)
-
-        with output.open('a') as fp:
-            for d in dbank:
-                if d.question not in history:
-                    print(json.dumps(asdict(d)), file=fp)
-                    history.add(d.question)
-
-    def setup_and_load(self, output):
-        history = self.history[output]
-        if not output.exists():
-            output.parent.mkdir(parents=True, exist_ok=True)
-        elif not history:
-            for d in Document.scanf(output):
-                history.add(d.question)
-
-        return history
-
 #
 #
 #
@@ -94,12 +91,16 @@ class DatasetAccessRequestor:
     }
     _endpoint = 'ask-access'
 
+    def __init__(self, limiter=nullcontext):
+        self.limiter = limiter
+
     def __call__(self, path):
         target = urlunparse(self.to_url(path))
         headers = build_hf_headers()
 
-        response = requests.post(target, headers=headers)
-        response.raise_for_status()
+        with self.limiter():
+            response = requests.post(target, headers=headers)
+            response.raise_for_status()
 
     def to_url(self, path):
         body = path.parts[:3]
@@ -111,18 +112,125 @@ class DatasetAccessRequestor:
 
         return ParseResult(**kwargs)
 
+#
+# Files are keyed by content (LFS sha256, or git blob id for small
+# files), so a new revision of a path is a new entry while the same
+# bytes are never fetched twice. Partial downloads are kept and resumed
+# from their last byte; completed files are evicted least recently used
+# first once the cache exceeds its size limit.
+#
+class DownloadCache:
+    _chunk = 2 ** 20
+    _part = '.part'
+
+    def __init__(self, root, backoff, retries, max_bytes=None,
+                 limiter=nullcontext):
+        self.root = root
+        self.backoff = backoff
+        self.retries = retries
+        self.max_bytes = max_bytes
+        self.limiter = limiter
+        self.fs = fsspec.filesystem('hf')
+
+    def __call__(self, url):
+        with self.limiter():
+            info = self.fs.info(url)
+        key = self.key(info)
+        path = self.root.joinpath(key[:2], key)
+
+        if path.exists():
+            os.utime(path)
+        else:
+            self.fetch(url, path, info['size'])
+            self.evict(path)
+
+        return path
+
+    def key(self, info):
+        lfs = info.get('lfs') or {}
+        return lfs.get('sha256', info['blob_id'])
+
+    def fetch(self, url, path, size):
+        part = path.with_suffix(self._part)
+        part.parent.mkdir(parents=True, exist_ok=True)
+
+        with part.open('ab') as dst:
+            fcntl.flock(dst, fcntl.LOCK_EX)
+            if path.exists():
+                return
+
+            for (i, j) in enumerate(self.backoff, 1):
+                offset = dst.tell()
+                try:
+                    with self.limiter():
+                        src = self.fs.open(url, mode='rb', cache_type='none')
+                    with src:
+                        src.seek(offset)
+                        while True:
+                            with self.limiter():
+                                chunk = src.read(self._chunk)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                    dst.flush()
+                    break
+                except GatedRepoError:
+                    raise
+                except Exception as err:
+                    dst.flush()
+                    if i >= self.retries:
+                        raise
+                    Logger.error(
+                        '%s: %s (offset=%d, attempt=%d, backoff=%ds)',
+                        type(err).__name__,
+                        err,
+                        dst.tell(),
+                        i,
+                        j,
+                    )
+                time.sleep(j)
+
+            if dst.tell() != size:
+                part.unlink()
+                raise ValueError(f'{url}: expected {size} bytes, got {dst.tell()}')
+            part.replace(path)
+
+    def evict(self, keep):
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for i in self.root.rglob('*'):
+            if i.is_file() and i.suffix != self._part:
+                entries.append((i.stat(), i))
+        total = sum(x.st_size for (x, _) in entries)
+        entries.sort(key=lambda x: x[0].st_mtime)
+
+        for (stat, path) in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            Logger.debug('evicting %s', path)
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
 class HfFileReader:
-    def __init__(self):
-        self.ask = DatasetAccessRequestor()
+    _chunk = 2 ** 20
+
+    def __init__(self, cache=None, limiter=nullcontext):
+        self.ask = DatasetAccessRequestor(limiter)
         self.path = DatasetPathHandler()
+        self.cache = cache
+        self.limiter = limiter
 
     def __call__(self, target):
         url = self.path.to_string(target)
         for i in it.count():
             try:
-                with fsspec.open(url) as fp:
-                    for line in fp:
-                        yield json.loads(line)
+                with self.open(url) as fp:
+                    for line in self.lines(fp):
+                        yield loads(line)
                 break
             except GatedRepoError as err:
                 if i:
@@ -136,6 +244,40 @@ class HfFileReader:
             except HTTPError as err:
                 raise PermissionError(target) from err
 
+    def open(self, url):
+        if self.cache is None:
+            (fs, path) = fsspec.core.url_to_fs(url)
+            with self.limiter():
+                return fs.open(path, mode='rb', cache_type='none')
+        return self.cache(url).open('rb')
+
+    #
+    # Without a cache every read is an HTTP range request, so the file
+    # is read in blocks (one request each) under the limiter, and a
+    # throttled read cuts the rate like any other request.
+    #
+    def lines(self, fp):
+        if self.cache is not None:
+            yield from fp
+            return
+
+        tail = b''
+        while True:
+            with self.limiter():
+                block = fp.read(self._chunk)
+            if not block:
+                break
+            (*lines, tail) = (tail + block).split(b'\n')
+            yield from lines
+        if tail:
+            yield tail
+
+#
+# Lines are parsed in blocks of `chunksize` into columns (one list per
+# `Result` field) that become a DataFrame in a single constructor call.
+# Metric keys are resolved once per line schema (its key tuple) rather
+# than per line.
+#
 class SubmissionReader:
     _document_keys = (
         'doc',
@@ -145,87 +287,200 @@ class SubmissionReader:
         'acc',
         'match',
     )
+    _columns = tuple(x.name for x in fields(Result))
 
-    def __init__(self, reader):
+    def __init__(self, reader, chunksize, seen=(), missing=None):
         self.reader = reader
-        self.documents = []
+        self.chunksize = chunksize
+        self.seen = seen
+        self.missing = missing
+        self.documents = {}
+        self.schemas = {}
 
     def __call__(self, submission):
         path = Path(submission['path'])
-        for r in self.results(path):
-            record = dict(submission)
-            record.update(asdict(r))
-            yield record
+        lines = self.reader(path)
+        while True:
+            block = list(it.islice(lines, self.chunksize))
+            if not block:
+                break
+            yield pd.DataFrame(dict(submission, **self.results(block)))
 
-    def results(self, path):
-        for line in self.reader(path):
-            document = line['doc_hash']
-            self.store(document, line)
-            for (metric, score) in line.items():
-                if any(metric.find(x) >= 0 for x in self._metrics):
-                    yield Result(document, metric, score)
+    def results(self, lines):
+        columns = { x: [] for x in self._columns }
+        (documents, metrics, scores) = columns.values()
+        block = {}
 
-    def store(self, doc, info):
-        content = { x: info[x] for x in self._document_keys }
-        document = Document(doc, content)
-        self.documents.append(document)
+        for line in lines:
+            document = line['doc_hash']
+            if document not in block:
+                block[document] = line
+            for metric in self.schema(line):
+                score = line[metric]
+                if type(score) is not float:
+                    score = to_float(score)
+                documents.append(document)
+                metrics.append(metric)
+                scores.append(score)
+        self.store(block)
+
+        return columns
+
+    def schema(self, line):
+        keys = tuple(line)
+        metrics = self.schemas.get(keys)
+        if metrics is None:
+            metrics = [
+                x for x in keys if any(x.find(y) >= 0 for y in self._metrics)
+            ]
+            self.schemas[keys] = metrics
+
+        return metrics
+
+    #
+    # Only questions that are new to this worker (not seen in earlier
+    # submissions, earlier blocks, or the bank) are kept, so memory is
+    # bounded by what has to be sent rather than by the file length.
+    #
+    def store(self, block):
+        fresh = (
+            Document(x, { y: info[y] for y in self._document_keys })
+            for (x, info) in block.items()
+            if x not in self.seen and x not in self.documents
+        )
+        if self.missing is not None:
+            fresh = self.missing(fresh)
+        self.documents.update((x.question, x) for x in fresh)
 
 #
 #
 #
-def func(incoming, outgoing, args):
-    hf_reader = HfFileReader()
+def func(incoming, outgoing, limiter, args):
+    if limiter is None:
+        limiter = nullcontext
+
+    cache = None
+    if args.cache is not None:
+        max_bytes = None
+        if args.cache_size is not None:
+            max_bytes = int(args.cache_size * 2 ** 30)
+        backoff = Backoff(args.backoff, 0.1)
+        cache = DownloadCache(
+            args.cache,
+            backoff,
+            args.retries,
+            max_bytes,
+            limiter,
+        )
+    hf_reader = HfFileReader(cache, limiter)
+    fmt = CorpusFormat.from_name(args.format)
     keys = [ x.name for x in fields(SubmissionInfo) ]
+    bank = QuestionBank(args.question_bank)
+    seen = cl.defaultdict(set)
+    manifest = None
+    if args.manifest is not None:
+        manifest = CorpusManifest(args.manifest)
 
     while True:
         submission = incoming.get()
         Logger.info(submission['path'])
 
-        reader = SubmissionReader(hf_reader)
+        entry = SubmissionInfo(*map(submission.get, keys))
+        info = entry
+        if not info.subject:
+            info = replace(info, subject='_')
+
+        #
+        # Batches are written as they are parsed; the output appears
+        # (atomically) only once the whole submission has been read.
+        #
+        name = Path(info.benchmark, info.subject)
+        history = seen[name]
+        reader = SubmissionReader(
+            hf_reader,
+            args.batch_size,
+            history,
+            ft.partial(bank.missing, name),
+        )
+        out = args.output.joinpath(info.to_path(fmt.suffix))
         try:
-            df = pd.DataFrame.from_records(reader(submission))
+            with fmt.writer(out) as writer:
+                for df in reader(submission):
+                    writer(df)
         except (PermissionError, ConnectionError) as err:
             Logger.critical('%s: %s', type(err), err)
             outgoing.put(None)
             continue
 
-        info = SubmissionInfo(*map(submission.get, keys))
-        if not info.subject:
-            info = replace(info, subject='_')
-
-        if not df.empty:
-            out = args.output.joinpath(info.to_path('.csv.gz'))
-            out.parent.mkdir(parents=True, exist_ok=True)
-            df.to_csv(out, index=False, compression='gzip')
+        if writer.rows and manifest is not None:
+            manifest.update(entry, submission['date'])
 
-        name = Path(info.benchmark, info.subject)
-        dbank = DocumentBank(name, reader.documents)
+        #
+        # The reader has already dropped documents this worker has
+        # seen, or that are in the bank; the rest go to the parent.
+        #
+        dbank = DocumentBank(name, list(reader.documents.values()))
+        history.update(reader.documents)
         outgoing.put(dbank)
 
-if __name__ == '__main__':
-    arguments = ArgumentParser()
-    arguments.add_argument('--output', type=Path)
-    arguments.add_argument('--question-bank', type=Path)
-    arguments.add_argument('--workers', type=int)
-    args = arguments.parse_args()
-
+def run(args, rows, limiter=None):
     incoming = Queue()
     outgoing = Queue()
     initargs = (
         outgoing,
         incoming,
+        limiter,
         args,
     )
 
     with Pool(args.workers, func, initargs):
+        bank = QuestionBank(args.question_bank)
+
+        def collect():
+            dbank = incoming.get()
+            if dbank is not None:
+                bank.write(dbank.name, dbank)
+
+        #
+        # Rows may arrive slowly (when streamed from a listing), so bank
+        # whatever results are already waiting as each new job goes out.
+        #
         jobs = 0
-        reader = csv.DictReader(sys.stdin)
-        for row in reader:
+        for row in rows:
             outgoing.put(row)
             jobs += 1
+            while jobs and not incoming.empty():
+                collect()
+                jobs -= 1
 
-        aggregate = DocumentAggregator(args.question_bank)
         for _ in range(jobs):
-            dbank = incoming.get()
-            if dbank is not None:
-                aggregate(dbank)
+            collect()
+
+def add_arguments(parser):
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--question-bank', type=Path)
+    parser.add_argument('--manifest', type=Path)
+    parser.add_argument('--format', choices=('csv', 'parquet'), default='csv')
+    parser.add_argument('--cache', type=Path)
+    parser.add_argument('--cache-size', type=float, help='GiB')
+    parser.add_argument('--backoff', type=float, default=15)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=int(1e4))
+    parser.add_argument('--workers', type=int)
+
+if __name__ == '__main__':
+    arguments = ArgumentParser()
+    add_arguments(arguments)
+    arguments.add_argument('--rate', type=float, help='requests/second')
+    arguments.add_argument('--max-rate', type=float, help='requests/second')
+    args = arguments.parse_args()
+
+    limiter = None
+    if args.rate is not None:
+        limiter = RateLimiter(
+            args.rate,
+            args.max_rate,
+            max_concurrency=args.workers or os.cpu_count(),
+        )
+
+    run(args, csv.DictReader(sys.stdin), limiter)
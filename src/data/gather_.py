@@ -35,9 +35,8 @@ class Submission:
             subject=subject,
         )
 
-def records(fp):
-    reader = csv.DictReader(fp)
-    for row in reader:
+def records(rows):
+    for row in rows:
         submission = Submission(**row)
         try:
             sample = submission.to_sample()
@@ -52,5 +51,5 @@ def records(fp):
         yield rec
 
 if __name__ == '__main__':
-    df = pd.DataFrame.from_records(records(sys.stdin))
+    df = pd.DataFrame.from_records(records(csv.DictReader(sys.stdin)))
     df.to_csv(sys.stdout, index=False)
@@ -1,15 +1,19 @@
+import os
 import sys
 import csv
+import json
 import time
 from pathlib import Path
+from contextlib import nullcontext
 from datetime import datetime
 from argparse import ArgumentParser
-from dataclasses import dataclass, asdict, fields
+from dataclasses import dataclass, field, asdict, fields
 from multiprocessing import Pool, Queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from huggingface_hub import HfApi, HfFileSystem
 
-from mylib import Logger, Backoff, DatasetPathHandler
+from mylib import Logger, Backoff, RateLimiter, DatasetPathHandler
 
 @dataclass
 class Result:
@@ -23,17 +27,88 @@ class Result:
     def __lt__(self, other):
         return self.date < other.date
 
+@dataclass
+class Listing:
+    dataset: str
+    revision: str
+    results: list = field(default_factory=list)
+
+    def __iter__(self):
+        yield from self.results
+
+#
+#
+#
+class ListingCache:
+    _suffix = '.json'
+
+    def __init__(self, root, max_age=None, refresh=False):
+        self.root = root
+        self.max_age = max_age
+        self.refresh = refresh
+
+    def __iter__(self):
+        for i in self.root.rglob(f'*{self._suffix}'):
+            if i.name.startswith('.'):
+                continue
+            (listing, _) = self.load(i)
+            yield listing
+
+    def get(self, dataset, revision):
+        path = self.to_path(dataset)
+        if self.refresh or not path.exists():
+            return None
+
+        (listing, cached) = self.load(path)
+        if listing.revision != revision:
+            Logger.debug('%s: revision changed', dataset)
+            return None
+        if self.max_age is not None:
+            age = (time.time() - cached) / 3600
+            if age > self.max_age:
+                Logger.debug('%s: expired (%.1fh)', dataset, age)
+                return None
+
+        return listing
+
+    def put(self, listing):
+        path = self.to_path(listing.dataset)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        data = {
+            'cached': time.time(),
+            'listing': asdict(listing),
+        }
+        tmp = path.with_name(f'.{path.name}')
+        tmp.write_text(json.dumps(data, default=str))
+        tmp.replace(path)
+
+    def load(self, path):
+        data = json.loads(path.read_text())
+        listing = Listing(**data['listing'])
+        return (listing, data['cached'])
+
+    def to_path(self, dataset):
+        return self.root.joinpath(f'{dataset}{self._suffix}')
+
+#
+#
+#
 class DatasetFileSystem:
-    def __init__(self, backoff):
+    def __init__(self, backoff, in_flight=1, fs=None, limiter=None):
         self.backoff = backoff
-        self.fs = HfFileSystem()
+        self.fs = HfFileSystem() if fs is None else fs
+        self.limiter = nullcontext if limiter is None else limiter
         self.path = DatasetPathHandler()
+        self.executor = ThreadPoolExecutor(in_flight)
 
     def ls(self, target):
         target = self.path.to_string(target)
         for (i, j) in enumerate(self.backoff, 1):
             try:
-                yield from self.fs.ls(target)
+                with self.limiter():
+                    entries = self.fs.ls(target)
+                yield from entries
                 break
             except Exception as err:
                 Logger.error(
@@ -46,60 +121,127 @@ class DatasetFileSystem:
             time.sleep(j)
 
     def walk(self, target):
+        futures = []
         for i in self.ls(target):
-            name = i['name']
-            if self.fs.isdir(name):
-                for j in self.ls(name):
-                    path = Path(j['name'])
-                    if path.stem.startswith('samples_'):
-                        date = j['last_commit'].date
-                        yield Result(path, date)
-
-def func(incoming, outgoing, args):
-    fs = DatasetFileSystem(Backoff(args.backoff, 0.1))
-    results = {}
+            if i['type'] == 'directory':
+                f = self.executor.submit(self.samples, i['name'])
+                futures.append(f)
 
-    while True:
-        dataset = incoming.get()
-        Logger.info(dataset)
+        for f in as_completed(futures):
+            yield from f.result()
+
+    def samples(self, target):
+        results = []
+        for i in self.ls(target):
+            path = Path(i['name'])
+            if path.stem.startswith('samples_'):
+                date = i['last_commit'].date
+                results.append(Result(path, date))
+
+        return results
+
+def earliest(results):
+    db = {}
+    for i in results:
+        key = repr(i)
+        if key not in db or i < db[key]:
+            db[key] = i
 
-        results.clear()
-        for i in fs.walk(dataset):
-            key = repr(i)
-            if key not in results or i < results[key]:
-                results[key] = i
+    return db.values()
 
-        outgoing.put(list(map(asdict, results.values())))
+def func(incoming, outgoing, limiter, args):
+    backoff = Backoff(args.backoff, 0.1)
+    fs = DatasetFileSystem(backoff, args.in_flight, limiter=limiter)
+
+    while True:
+        listing = incoming.get()
+        Logger.info(listing.dataset)
+
+        for i in earliest(fs.walk(Path(listing.dataset))):
+            listing.results.append({ x: str(y) for (x, y) in asdict(i).items() })
+        outgoing.put(listing)
+
+def datasets(args):
+    api = HfApi()
+    iterable = api.list_datasets(
+        author=args.author,
+        search='-details',
+        expand=['sha', 'lastModified'],
+    )
+    for i in iterable:
+        revision = i.sha
+        if revision is None and i.last_modified is not None:
+            revision = str(i.last_modified)
+        yield Listing(i.id, revision)
+
+def records(args, limiter=None):
+    cache = None
+    if args.cache is not None:
+        cache = ListingCache(args.cache, args.max_age, args.refresh)
+        if args.offline:
+            for i in cache:
+                yield from i
+            return
 
-def records(args):
     incoming = Queue()
     outgoing = Queue()
     initargs = (
         outgoing,
         incoming,
+        limiter,
         args,
     )
 
     with Pool(args.workers, func, initargs):
-        api = HfApi()
-
         jobs = 0
-        for i in api.list_datasets(author=args.author, search='-details'):
-            outgoing.put(Path(i.id))
+        for i in datasets(args):
+            # without a revision a cached listing can never be shown
+            # to be out of date, so it is neither read nor written
+            if cache is not None and i.revision is not None:
+                listing = cache.get(i.dataset, i.revision)
+                if listing is not None:
+                    Logger.info('%s (cached)', i.dataset)
+                    yield from listing
+                    continue
+            outgoing.put(i)
             jobs += 1
 
         for _ in range(jobs):
-            results = incoming.get()
-            yield from results
+            listing = incoming.get()
+            if cache is not None and listing.revision is not None:
+                cache.put(listing)
+            yield from listing
+
+def add_arguments(parser):
+    parser.add_argument('--author', default='open-llm-leaderboard')
+    parser.add_argument('--backoff', type=float, default=15)
+    parser.add_argument('--cache', type=Path)
+    parser.add_argument('--max-age', type=float, help='hours')
+    parser.add_argument('--refresh', action='store_true')
+    parser.add_argument('--offline', action='store_true')
+    parser.add_argument('--in-flight', type=int, default=8)
+    parser.add_argument('--workers', type=int)
 
 if __name__ == '__main__':
     arguments = ArgumentParser()
-    arguments.add_argument('--author', default='open-llm-leaderboard')
-    arguments.add_argument('--backoff', type=float, default=15)
-    arguments.add_argument('--workers', type=int)
+    add_arguments(arguments)
+    arguments.add_argument('--rate', type=float, help='requests/second')
+    arguments.add_argument('--max-rate', type=float, help='requests/second')
     args = arguments.parse_args()
 
+    if args.offline and args.cache is None:
+        arguments.error('--offline requires --cache')
+
+    limiter = None
+    if args.rate is not None:
+        workers = args.workers or os.cpu_count()
+        limiter = RateLimiter(
+            args.rate,
+            args.max_rate,
+            max_concurrency=workers * args.in_flight,
+        )
+
     fieldnames = [ x.name for x in fields(Result) ]
     writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
     writer.writeheader()
-    writer.writerows(records(args))
+    writer.writerows(records(args, limiter))
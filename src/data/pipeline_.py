@@ -0,0 +1,75 @@
+import os
+from pathlib import Path
+from argparse import ArgumentParser, Namespace
+
+import list_
+import gather_
+import reduce_
+import download_
+from mylib import Logger, RateLimiter
+
+#
+# Stage 1 (list | gather | reduce | download) in one process tree.
+# Each stage is a generator over the previous one, so downloads start
+# with the first dataset listed. Rows are stringified before download,
+# as they would have been by the CSV hand-off between scripts.
+#
+def stringify(rows):
+    for row in rows:
+        yield { x: str(y) for (x, y) in row.items() }
+
+#
+# Each stage declares its own options (add_arguments); the listing
+# stage's are prefixed so that its cache and worker count do not
+# collide with the download stage's. Options the reduce and download
+# stages have in common are given once and shared.
+#
+class Prefixed:
+    def __init__(self, parser, prefix):
+        self.parser = parser
+        self.prefix = prefix
+
+    def add_argument(self, option, **kwargs):
+        option = option.replace('--', f'--{self.prefix}-', 1)
+        return self.parser.add_argument(option, **kwargs)
+
+def namespace(module, args, prefix=None):
+    parser = ArgumentParser()
+    module.add_arguments(parser)
+    names = { x: x for x in vars(parser.parse_args([])) }
+    if prefix is not None:
+        names = { x: f'{prefix}_{x}' for x in names }
+
+    return Namespace(**{ x: getattr(args, y) for (x, y) in names.items() })
+
+if __name__ == '__main__':
+    arguments = ArgumentParser(conflict_handler='resolve')
+    list_.add_arguments(Prefixed(arguments, 'listing'))
+    reduce_.add_arguments(arguments)
+    download_.add_arguments(arguments)
+    arguments.add_argument('--rate', type=float, help='requests/second')
+    arguments.add_argument('--max-rate', type=float, help='requests/second')
+    args = arguments.parse_args()
+
+    if args.listing_offline and args.listing_cache is None:
+        arguments.error('--listing-offline requires --listing-cache')
+    if args.corpus is None:
+        args.corpus = args.output
+
+    list_args = namespace(list_, args, 'listing')
+    reduce_args = namespace(reduce_, args)
+    download_args = namespace(download_, args)
+
+    limiter = None
+    if args.rate is not None:
+        workers = (list_args.workers or os.cpu_count()) * list_args.in_flight
+        workers += download_args.workers or os.cpu_count()
+        limiter = RateLimiter(args.rate, args.max_rate, max_concurrency=workers)
+
+    db = dict(reduce_.load(reduce_args))
+    Logger.info('%d submissions in corpus', len(db))
+
+    rows = list_.records(list_args, limiter)
+    rows = gather_.records(rows)
+    rows = reduce_.extract(db, rows)
+    download_.run(download_args, stringify(rows), limiter)
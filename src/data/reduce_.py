@@ -1,6 +1,5 @@
 import sys
 import csv
-import gzip
 from pathlib import Path
 from argparse import ArgumentParser
 from dataclasses import fields, astuple
@@ -8,13 +7,14 @@ from multiprocessing import Pool
 
 import pandas as pd
 
-from mylib import Logger, SubmissionInfo
+from mylib import Logger, SubmissionInfo, CorpusFormat, CorpusManifest
 
 #
 #
 #
 class SubmissionParser:
     _keys = [ x.name for x in fields(SubmissionInfo) ]
+    columns = _keys + [ 'date' ]
 
     def __call__(self, data):
         info = SubmissionInfo(*map(data.get, self._keys))
@@ -28,40 +28,57 @@ def func(path):
     Logger.debug(path)
 
     parser = SubmissionParser()
-    with gzip.open(path, mode='rt') as fp:
-        reader = csv.DictReader(fp)
-        for row in reader:
-            return parser(row)
+    row = CorpusFormat.from_path(path).head(path, parser.columns)
+    if row is not None:
+        return parser(row)
 
     Logger.critical('removing empty file %s', path)
     path.unlink()
 
 def scan(args):
     with Pool(args.workers) as pool:
-        iterable = args.corpus.rglob('*.csv.gz')
+        iterable = CorpusFormat.glob(args.corpus)
         yield from filter(None, pool.imap_unordered(func, iterable))
 
-def extract(db, fp):
+def load(args):
+    if args.manifest is None:
+        yield from scan(args)
+        return
+
+    rebuild = args.rebuild or not args.manifest.exists()
+    manifest = CorpusManifest(args.manifest)
+    if rebuild:
+        Logger.warning('rebuilding %s', args.manifest)
+        manifest.extend(scan(args), clear=True)
+
+    for (info, date) in manifest:
+        yield (info, pd.to_datetime(date))
+
+def extract(db, rows):
     parser = SubmissionParser()
-    reader = csv.DictReader(fp)
-    for row in reader:
+    for row in rows:
         (info, date) = parser(row)
         if info in db and db[info] <= date:
             Logger.warning('skipping %s', info.to_path())
             continue
         yield row
 
+def add_arguments(parser):
+    parser.add_argument('--corpus', type=Path)
+    parser.add_argument('--manifest', type=Path)
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--workers', type=int)
+
 #
 #
 #
 if __name__ == '__main__':
     arguments = ArgumentParser()
-    arguments.add_argument('--corpus', type=Path)
-    arguments.add_argument('--workers', type=int)
+    add_arguments(arguments)
     args = arguments.parse_args()
 
     writer = None
-    for row in extract(dict(scan(args)), sys.stdin):
+    for row in extract(dict(load(args)), csv.DictReader(sys.stdin)):
         if writer is None:
             writer = csv.DictWriter(sys.stdout, fieldnames=row)
             writer.writeheader()
@@ -0,0 +1,97 @@
+import sys
+import csv
+import time
+import threading
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from mylib import Logger, RateLimiter
+
+#
+# Local stand-in for a throttling Hub: a fixed-window server that
+# answers 429 once more than `allowed` requests arrive in a second.
+#
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    allowed = None
+    window = [ 0, 0 ]
+    lock = threading.Lock()
+
+    def do_GET(self):
+        now = int(time.monotonic())
+        with self.lock:
+            if self.window[0] != now:
+                self.window[:] = [ now, 0 ]
+            self.window[1] += 1
+            status = 200 if self.window[1] <= self.allowed else 429
+
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+#
+#
+#
+def initializer(*args):
+    global _limiter, _url
+    (_limiter, _url) = args
+
+def func(_):
+    try:
+        with _limiter():
+            response = requests.get(_url)
+            response.raise_for_status()
+        return True
+    except requests.HTTPError:
+        return False
+
+if __name__ == '__main__':
+    arguments = ArgumentParser()
+    arguments.add_argument('--allowed', type=int, default=50)
+    arguments.add_argument('--rate', type=float, default=10)
+    arguments.add_argument('--max-rate', type=float)
+    arguments.add_argument('--requests', type=int, default=1000)
+    arguments.add_argument('--workers', type=int, default=8)
+    args = arguments.parse_args()
+
+    ThrottlingHandler.allowed = args.allowed
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://{}:{}/'.format(*server.server_address)
+
+    limiter = RateLimiter(
+        args.rate,
+        args.max_rate or args.allowed,
+        max_concurrency=args.workers,
+    )
+    initargs = (
+        limiter,
+        url,
+    )
+
+    start = time.perf_counter()
+    with Pool(args.workers, initializer, initargs) as pool:
+        results = pool.map(func, range(args.requests), chunksize=1)
+    seconds = time.perf_counter() - start
+    server.shutdown()
+
+    ok = sum(results)
+    Logger.info('%d ok in %.2fs', ok, seconds)
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=[
+        'seconds',
+        'ok',
+        'throttled',
+        'throughput',
+    ])
+    writer.writeheader()
+    writer.writerow({
+        'seconds': round(seconds, 3),
+        'ok': ok,
+        'throttled': len(results) - ok,
+        'throughput': round(ok / seconds, 2),
+    })
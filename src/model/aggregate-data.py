@@ -1,15 +1,25 @@
 import sys
-import csv
 import json
+import hashlib
 import itertools as it
+import functools as ft
+import collections as cl
 from pathlib import Path
+from contextlib import ExitStack
 from argparse import ArgumentParser
 from dataclasses import dataclass, fields, asdict
 from multiprocessing import Pool, Queue
 
 import pandas as pd
 
-from mylib import Logger, Experiment, SubmissionInfo, Document
+from mylib import (
+    Logger,
+    Document,
+    Experiment,
+    SharedFrame,
+    CorpusFormat,
+    SubmissionInfo,
+)
 
 #
 #
@@ -38,19 +48,15 @@ class BenchmarkHandler:
         if view.empty:
             raise ValueError(f'{self.metric} not in data')
 
-        observations = view.itertuples(index=False)
-        for i in self.handle(subject, observations):
-            args = (getattr(i, x) for x in self._r_fields)
-            yield Record(*args)
+        return view.loc[self.handle(subject, view), list(self._r_fields)]
 
-    def handle(self, subject, observations):
+    def handle(self, subject, view):
         raise NotImplementedError()
 
 # Subjects included in directory structure
 class DirectoryHandler(BenchmarkHandler):
-    def handle(self, subject, observations):
-        if self.info.subject == subject:
-            yield from observations
+    def handle(self, subject, view):
+        return slice(None) if self.info.subject == subject else view.index[:0]
 
 class BigBenchHard(DirectoryHandler):
     def __init__(self, info, documents):
@@ -64,21 +70,27 @@ class Math(DirectoryHandler):
     def __init__(self, info, documents):
         super().__init__(info, documents, 'exact_match')
 
-# Subjects included in docs
+# Subjects included in docs. The question -> subject map is the same
+# for every submission on a subject, so each worker keeps the most
+# recently used maps, keyed by question bank path and modification
+# time.
 class IndexedCategoryBenchmark(BenchmarkHandler):
     def __init__(self, info, documents, metric, s_key):
         super().__init__(info, documents, metric)
-        self.subjects = dict(self.load(s_key))
+        mtime = self.documents.stat().st_mtime_ns
+        self.subjects = self.load(self.documents, mtime, s_key)
 
-    def load(self, s_key):
-        for i in Document.scanf(self.documents):
-            value = i.content['doc'][s_key]
-            yield (i.question, value)
+    @staticmethod
+    @ft.lru_cache(maxsize=16)
+    def load(documents, mtime, s_key):
+        subjects = {}
+        for i in Document.scanf(documents):
+            subjects[i.question] = i.content['doc'][s_key]
 
-    def handle(self, subject, observations):
-        for o in observations:
-            if self.subjects[o.document] == subject:
-                yield o
+        return subjects
+
+    def handle(self, subject, view):
+        return view['document'].map(self.subjects).eq(subject).to_numpy()
 
 class MultitaskUnderstanding(IndexedCategoryBenchmark):
     def __init__(self, info, documents):
@@ -90,8 +102,8 @@ class GraduateLevelGoogleProofQA(IndexedCategoryBenchmark):
 
 # Do not have the concept of subject
 class NoSubjectBenchmark(BenchmarkHandler):
-    def handle(self, subject, observations):
-        yield from observations
+    def handle(self, subject, view):
+        return slice(None)
 
 class AbstractionReasoningCorpus(NoSubjectBenchmark):
     def __init__(self, info, documents):
@@ -106,10 +118,60 @@ class InstructionFollowingEval(NoSubjectBenchmark):
         super().__init__(info, documents, 'prompt_level_strict_acc')
 
 #
+# Per-(experiment, submission) results, kept between runs. A partition
+# is named after its submission's size and modification time under a
+# directory named after the experiment's definition, so a changed
+# submission or experiment simply misses the store.
 #
+class PartitionStore:
+    _suffix = '.parquet'
+
+    def __init__(self, root, data_root, experiments):
+        self.root = root
+        self.data_root = data_root
+        self.keys = list(map(self.digest, experiments))
+
+    @staticmethod
+    def digest(experiment):
+        data = json.dumps(asdict(experiment), sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    def to_path(self, index, path):
+        stat = path.stat()
+        relative = path.relative_to(self.data_root)
+        name = '{}.{}-{}{}'.format(
+            relative.name,
+            stat.st_size,
+            stat.st_mtime_ns,
+            self._suffix,
+        )
+
+        return self.root.joinpath(self.keys[index], relative.parent, name)
+
+    def exists(self, index, path):
+        return self.to_path(index, path).exists()
+
+    def get(self, index, path):
+        return pd.read_parquet(self.to_path(index, path))
+
+    def put(self, index, path, df):
+        target = self.to_path(index, path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        prefix = f'{path.name}.'
+        for i in target.parent.iterdir():
+            if i.name.startswith(prefix) and i.suffix == self._suffix:
+                i.unlink()
+
+        tmp = target.with_name(f'.{target.name}')
+        df.to_parquet(tmp, index=False)
+        tmp.replace(target)
+
 #
-def func(incoming, outgoing, experiment, args):
-    Handler = {
+#
+#
+def func(incoming, outgoing, experiments, args):
+    Handlers = {
         'bbh': BigBenchHard,
         'arc': AbstractionReasoningCorpus,
         'math': Math,
@@ -118,62 +180,124 @@ def func(incoming, outgoing, experiment, args):
         'gpqa': GraduateLevelGoogleProofQA,
         'gsm8k': GradeSchoolMath8K,
         'ifeval': InstructionFollowingEval,
-    }[experiment.benchmark]
+    }
+    columns = [ x.name for x in fields(Record) ] + [ 'metric' ]
 
     while True:
-        path = incoming.get()
+        (path, requested) = incoming.get()
         Logger.info(path)
 
-        df = pd.read_csv(path, compression='gzip', memory_map=True)
         info = SubmissionInfo.from_path(path.relative_to(args.data_root))
         documents = (args
                      .question_bank
-                     .joinpath(experiment.benchmark, info.subject)
+                     .joinpath(info.benchmark, info.subject)
                      .with_suffix('.jsonl'))
-        handler = Handler(info, documents)
+        handler = Handlers[info.benchmark](info, documents)
+
+        reader = CorpusFormat.from_path(path)
+        df = reader.read(path, columns, [ handler.metric ])
 
-        for e in experiment:
+        #
+        # Each subject is handled once, then routed to every experiment
+        # that includes it.
+        #
+        targets = cl.defaultdict(list)
+        for i in requested:
+            for s in experiments[i]:
+                targets[s].append(i)
+
+        for (s, indices) in targets.items():
             try:
-                records = list(handler(df, e))
+                records = handler(df, s)
             except ValueError as err:
-                Logger.error('%s %s: %s', path, e, err)
+                Logger.error('%s %s: %s', path, s, err)
                 continue
-            outgoing.put(records)
-        outgoing.put(None)
+            if not records.empty:
+                shared = SharedFrame.from_frame(records)
+                outgoing.put((path, indices, shared))
+        outgoing.put((path, None, None))
 
+#
+#
+#
 if __name__ == '__main__':
     arguments = ArgumentParser()
     arguments.add_argument('--data-root', type=Path)
     arguments.add_argument('--question-bank', type=Path)
-    arguments.add_argument('--experiment', type=Path)
+    arguments.add_argument('--experiment', type=Path, action='append')
+    arguments.add_argument('--output', help='file name, relative to each experiment')
+    arguments.add_argument('--partitions', type=Path)
+    arguments.add_argument('--queue-size', type=int, default=64)
     arguments.add_argument('--workers', type=int)
     args = arguments.parse_args()
 
-    experiment = Experiment(**json.loads(args.experiment.read_text()))
+    if args.output is None and len(args.experiment) > 1:
+        arguments.error('multiple experiments require --output')
+
+    experiments = []
+    for i in args.experiment:
+        experiments.append(Experiment(**json.loads(i.read_text())))
 
-    incoming = Queue()
+    store = None
+    if args.partitions is not None:
+        store = PartitionStore(args.partitions, args.data_root, experiments)
+
+    incoming = Queue(args.queue_size) # bounds batches awaiting the writer
     outgoing = Queue()
     initargs = (
         outgoing,
         incoming,
-        experiment,
+        experiments,
         args,
     )
 
-    with Pool(args.workers, func, initargs):
-        jobs = 0
-        root = args.data_root.joinpath(experiment.benchmark)
-        for i in root.rglob('*.csv.gz'):
-            outgoing.put(i)
-            jobs += 1
+    with Pool(args.workers, func, initargs), ExitStack() as stack:
+        inputs = []
+        requested = {}
+        for b in set(x.benchmark for x in experiments):
+            indices = [ i for (i, x) in enumerate(experiments) if x.benchmark == b ]
+            root = args.data_root.joinpath(b)
+            for i in CorpusFormat.glob(root):
+                inputs.append((i, indices))
+                missing = indices
+                if store is not None:
+                    missing = [ x for x in indices if not store.exists(x, i) ]
+                if missing:
+                    outgoing.put((i, missing))
+                    requested[i] = missing
+        Logger.info('%d of %d submissions to process', len(requested), len(inputs))
 
+        outputs = []
         fieldnames = [ x.name for x in fields(Record) ]
-        writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
-        writer.writeheader()
+        for i in args.experiment:
+            if args.output is None:
+                fp = sys.stdout
+            else:
+                fp = stack.enter_context(i.with_name(args.output).open('w'))
+            pd.DataFrame(columns=fieldnames).to_csv(fp, index=False)
+            outputs.append(fp)
 
+        pending = cl.defaultdict(list)
+        jobs = len(requested)
         while jobs:
-            rows = incoming.get()
-            if rows is None:
+            (path, indices, shared) = incoming.get()
+            if indices is None:
                 jobs -= 1
-            elif rows:
-                writer.writerows(map(asdict, rows))
+                if store is not None:
+                    frames = pending.pop(path, [])
+                    for i in requested[path]:
+                        view = [ y for (x, y) in frames if i in x ]
+                        df = pd.concat(view) if view else pd.DataFrame(columns=fieldnames)
+                        store.put(i, path, df)
+            elif store is None:
+                records = shared.to_frame()
+                for i in indices:
+                    records.to_csv(outputs[i], header=False, index=False)
+            else:
+                pending[path].append((indices, shared.to_frame()))
+
+        if store is not None:
+            for (path, indices) in inputs:
+                for i in indices:
+                    df = store.get(i, path)
+                    df.to_csv(outputs[i], header=False, index=False)
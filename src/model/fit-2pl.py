@@ -0,0 +1,262 @@
+import sys
+import json
+from pathlib import Path
+from argparse import ArgumentParser
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.special import expit, logsumexp
+
+from mylib import Logger
+
+#
+# Observations as written by prepare-data.py, with indices shifted to
+# zero. Compressed data carries per-cell trials; otherwise each
+# observation is a single trial.
+#
+@dataclass
+class Observations:
+    I: int
+    J: int
+    q: np.ndarray
+    p: np.ndarray
+    y: np.ndarray
+    trials: np.ndarray
+
+    @classmethod
+    def from_path(cls, path):
+        data = json.loads(path.read_text())
+        y = np.asarray(data['y'], dtype=float)
+        trials = data.get('trials', np.ones_like(y))
+
+        return cls(
+            I=data['I'],
+            J=data['J'],
+            q=np.asarray(data['q_i']) - 1,
+            p=np.asarray(data['p_j']) - 1,
+            y=y,
+            trials=np.asarray(trials, dtype=float),
+        )
+
+    def loglik(self, eta):
+        return self.y * eta - self.trials * np.logaddexp(0, eta)
+
+    def residual(self, eta):
+        return self.y - self.trials * expit(eta)
+
+#
+# Priors from model.stan; alpha is estimated on the log scale
+#
+class Prior:
+    @staticmethod
+    def alpha(a):
+        return (-(a - 0.5) ** 2 / 2, -(a - 0.5))
+
+    @staticmethod
+    def beta(b):
+        return (-b ** 2 / 200, -b / 100)
+
+    @staticmethod
+    def theta(t):
+        return (-t ** 2 / 2, -t)
+
+class Engine:
+    def __init__(self, iterations, tolerance):
+        self.iterations = iterations
+        self.tolerance = tolerance
+
+    def __call__(self, data):
+        raise NotImplementedError()
+
+    def minimize(self, func, x0, *args, iterations=None):
+        return minimize(
+            func,
+            x0,
+            args=args,
+            jac=True,
+            method='L-BFGS-B',
+            options={
+                'maxiter': iterations or self.iterations,
+                'ftol': self.tolerance,
+            },
+        )
+
+#
+# Joint maximum a posteriori over alpha, beta and theta
+#
+class JointMAP(Engine):
+    def __call__(self, data):
+        x0 = np.zeros(2 * data.I + data.J)
+        result = self.minimize(self.objective, x0, data)
+        Logger.info('MAP: %s (%d iterations)', result.message, result.nit)
+        (a, beta, theta) = np.split(result.x, [data.I, 2 * data.I])
+
+        return {
+            'alpha': np.exp(a),
+            'beta': beta,
+            'theta': theta,
+        }
+
+    def objective(self, x, data):
+        (a, beta, theta) = np.split(x, [data.I, 2 * data.I])
+        alpha = np.exp(a)
+
+        d = theta[data.p] - beta[data.q]
+        slope = alpha[data.q]
+        eta = slope * d
+        r = data.residual(eta)
+
+        (lp_a, g_a) = Prior.alpha(a)
+        (lp_b, g_b) = Prior.beta(beta)
+        (lp_t, g_t) = Prior.theta(theta)
+        lp = data.loglik(eta).sum() + lp_a.sum() + lp_b.sum() + lp_t.sum()
+        gradient = np.concatenate((
+            np.bincount(data.q, r * d, data.I) * alpha + g_a,
+            -np.bincount(data.q, r * slope, data.I) + g_b,
+            np.bincount(data.p, r * slope, data.J) + g_t,
+        ))
+
+        return (-lp, -gradient)
+
+#
+# Marginal maximum likelihood by EM: theta is integrated out against
+# its N(0, 1) prior with Gauss-Hermite quadrature. Item parameters are
+# (MAP) estimated in the M-step; abilities are posterior means over
+# the quadrature nodes once the items have converged.
+#
+class MarginalML(Engine):
+    def __init__(self, iterations, tolerance, nodes, m_iterations=5):
+        super().__init__(iterations, tolerance)
+        (self.x, w) = np.polynomial.hermite_e.hermegauss(nodes)
+        self.log_w = np.log(w / w.sum())
+        self.m_iterations = m_iterations
+
+    def __call__(self, data):
+        x0 = np.zeros(2 * data.I)
+        previous = None
+
+        for i in range(self.iterations):
+            (posterior, ll) = self.expect(x0, data)
+            result = self.minimize(
+                self.objective,
+                x0,
+                posterior,
+                data,
+                iterations=self.m_iterations,
+            )
+            x0 = result.x
+
+            Logger.info('EM %d: %.4f', i, ll)
+            if previous is not None:
+                if abs(ll - previous) <= self.tolerance * abs(previous):
+                    break
+            previous = ll
+
+        (posterior, _) = self.expect(x0, data)
+        (a, beta) = np.split(x0, 2)
+
+        return {
+            'alpha': np.exp(a),
+            'beta': beta,
+            'theta': self.x @ posterior,
+        }
+
+    # posterior over the nodes for each person, and the marginal
+    # log-likelihood; one pass over the observations per node
+    def expect(self, x0, data):
+        (a, beta) = np.split(x0, 2)
+        slope = np.exp(a)[data.q]
+        offset = beta[data.q]
+
+        log_p = np.tile(self.log_w, (data.J, 1))
+        for (k, node) in enumerate(self.x):
+            eta = slope * (node - offset)
+            log_p[:, k] += np.bincount(data.p, data.loglik(eta), data.J)
+        ll = logsumexp(log_p, axis=1, keepdims=True)
+
+        # node-major, so that each node's weights gather contiguously
+        posterior = np.exp(log_p - ll).T.copy()
+
+        return (posterior, ll.sum())
+
+    def objective(self, x0, posterior, data):
+        (a, beta) = np.split(x0, 2)
+        alpha = np.exp(a)
+        slope = alpha[data.q]
+        offset = beta[data.q]
+
+        lp = 0
+        g_a = np.zeros(data.I)
+        g_b = np.zeros(data.I)
+        for (k, node) in enumerate(self.x):
+            weight = posterior[k, data.p]
+            d = node - offset
+            eta = slope * d
+            r = weight * data.residual(eta)
+
+            lp += (weight * data.loglik(eta)).sum()
+            g_a += np.bincount(data.q, r * d, data.I)
+            g_b -= np.bincount(data.q, r * slope, data.I)
+
+        (lp_a, prior_a) = Prior.alpha(a)
+        (lp_b, prior_b) = Prior.beta(beta)
+        lp += lp_a.sum() + lp_b.sum()
+        gradient = np.concatenate((g_a * alpha + prior_a, g_b + prior_b))
+
+        return (-lp, -gradient)
+
+#
+# Same layout as from-stan.py: a single draw from a single chain
+#
+def melt(estimates, db):
+    vmap = {
+        'alpha': 'document',
+        'beta': 'document',
+        'theta': 'author_model',
+    }
+
+    for (parameter, values) in estimates.items():
+        sources = db[vmap[parameter]]
+        for (i, value) in enumerate(values, 1):
+            yield {
+                'sample': 0,
+                'value': value,
+                'chain': 1,
+                'source': sources[str(i)],
+                'parameter': parameter,
+            }
+
+_engines = {
+    'map': JointMAP,
+    'mml': MarginalML,
+}
+
+if __name__ == '__main__':
+    arguments = ArgumentParser()
+    arguments.add_argument('--stan', type=Path)
+    arguments.add_argument('--variables', type=Path)
+    arguments.add_argument('--engine', choices=_engines, default='mml')
+    arguments.add_argument('--iterations', type=int, default=500)
+    arguments.add_argument('--tolerance', type=float, default=1e-6)
+    arguments.add_argument('--nodes', type=int, default=21)
+    arguments.add_argument('--init', type=Path)
+    args = arguments.parse_args()
+
+    data = Observations.from_path(args.stan)
+    Logger.info('%s: I=%d J=%d N=%d', args.stan, data.I, data.J, len(data.y))
+
+    if args.engine == 'mml':
+        engine = MarginalML(args.iterations, args.tolerance, args.nodes)
+    else:
+        engine = _engines[args.engine](args.iterations, args.tolerance)
+    estimates = engine(data)
+
+    if args.init is not None:
+        inits = {x: y.tolist() for (x, y) in estimates.items()}
+        args.init.write_text(json.dumps(inits))
+
+    db = json.loads(args.variables.read_text())
+    df = pd.DataFrame.from_records(melt(estimates, db))
+    df.to_csv(sys.stdout, index=False)
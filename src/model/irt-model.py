@@ -1,43 +1,112 @@
 from pathlib import Path
 from argparse import ArgumentParser
 
+import numpy as np
 import pymc as pm
 import pandas as pd
+import numpyro
+
+from mylib import Logger
+
+#
+# Observations the likelihood is evaluated over: index vectors into
+# the item and person parameters, as in model.stan. Missing responses
+# are simply absent, so the graph grows with observations rather than
+# with persons x items.
+#
+class Responses:
+    def __init__(self, q_i, p_j, y, items, persons):
+        self.q_i = q_i
+        self.p_j = p_j
+        self.y = y
+        self.items = items
+        self.persons = persons
+
+    def __len__(self):
+        return len(self.y)
+
+class IndexedResponses(Responses):
+    def __init__(self, df):
+        df = df.dropna(subset='score')
+        q_i = df['document_id'].to_numpy() - 1
+        p_j = df['author_model_id'].to_numpy() - 1
+
+        super().__init__(
+            q_i,
+            p_j,
+            df['score'].to_numpy(dtype=int),
+            q_i.max() + 1,
+            p_j.max() + 1,
+        )
+
+class PivotedResponses(Responses):
+    def __init__(self, df):
+        view = df.pivot(
+            index=['author', 'model'],
+            columns='document',
+            values='score',
+        )
+        (p_j, q_i) = np.nonzero(view.notna().to_numpy())
+        (persons, items) = view.shape
+
+        super().__init__(
+            q_i,
+            p_j,
+            view.to_numpy()[p_j, q_i].astype(int),
+            items,
+            persons,
+        )
+
+_layouts = {
+    'index': IndexedResponses,
+    'pivot': PivotedResponses,
+}
 
 if __name__ == '__main__':
     arguments = ArgumentParser()
     arguments.add_argument('--data-file', type=Path)
     arguments.add_argument('--output', type=Path)
+    arguments.add_argument('--layout', choices=_layouts, default='index')
     arguments.add_argument('--seed', type=int)
+    arguments.add_argument('--chains', type=int, default=4)
+    arguments.add_argument('--chain-method',
+                           choices=('sequential', 'parallel', 'vectorized'),
+                           default='sequential')
     args = arguments.parse_args()
 
-    df = (pd
-          .read_csv(args.data_file,
-                    compression='gzip',
-                    memory_map=True)
-          .pivot(index=['author', 'model'],
-                 columns='question',
-                 values='score'))
-    (persons, items) = df.shape
+    # one CPU device per chain; must happen before JAX initialises
+    if args.chain_method == 'parallel':
+        numpyro.set_host_device_count(args.chains)
+
+    df = pd.read_csv(args.data_file, memory_map=True)
+    data = _layouts[args.layout](df)
+    Logger.info(
+        '%s: %d observations, %d items, %d persons',
+        args.data_file,
+        len(data),
+        data.items,
+        data.persons,
+    )
 
     with pm.Model() as model:
         # Priors
-        alpha = pm.LogNormal('alpha', mu=0.5, sigma=1, shape=items)
-        beta = pm.Normal('beta', mu=0, sigma=10, shape=items)
-        theta = pm.Normal('theta', mu=0, sigma=1, shape=persons)
+        alpha = pm.LogNormal('alpha', mu=0.5, sigma=1, shape=data.items)
+        beta = pm.Normal('beta', mu=0, sigma=10, shape=data.items)
+        theta = pm.Normal('theta', mu=0, sigma=1, shape=data.persons)
 
         # Linear predictor
-        eta = alpha[None, :] * (theta[:, None] - beta[None, :])
+        eta = alpha[data.q_i] * (theta[data.p_j] - beta[data.q_i])
 
         # Likelihood
         y_obs = pm.Bernoulli(
             'y_obs',
             logit_p=eta,
-            observed=df.to_numpy(),
+            observed=data.y,
         )
 
         trace = pm.sampling_jax.sample_numpyro_nuts(
-            # chain_method='vectorized',
+            chains=args.chains,
+            chain_method=args.chain_method,
             random_seed=args.seed,
             idata_kwargs={
                 'log_likelihood': False,
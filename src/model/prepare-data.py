@@ -0,0 +1,127 @@
+import json
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from mylib import Logger, VariableIds
+
+#
+# build-ids, to-stan and to-variables in one pass over the aggregate.
+#
+class StanWriter:
+    def __init__(self, chunksize):
+        self.chunksize = chunksize
+
+    def __call__(self, fp, data):
+        fp.write('{')
+        for (i, (k, v)) in enumerate(data.items()):
+            if i:
+                fp.write(', ')
+            fp.write(f'{json.dumps(k)}: ')
+            if isinstance(v, np.ndarray):
+                self.array(fp, v)
+            else:
+                fp.write(json.dumps(v))
+        fp.write('}\n')
+
+    def array(self, fp, values):
+        fp.write('[')
+        for i in range(0, len(values), self.chunksize):
+            if i:
+                fp.write(', ')
+            view = values[i:i + self.chunksize]
+            fp.write(', '.join(view.astype(str)))
+        fp.write(']')
+
+#
+# Collapse repeated (question, person) observations into one cell with
+# success and trial counts, for model-binomial.stan.
+#
+def compress(data):
+    key = (data['q_i'] - 1) * data['J'] + (data['p_j'] - 1)
+    (cells, inverse, trials) = np.unique(
+        key,
+        return_inverse=True,
+        return_counts=True,
+    )
+    y = np.bincount(inverse, weights=data['y'], minlength=len(cells))
+    Logger.info('%d observations -> %d cells', data['N'], len(cells))
+
+    return dict(
+        data,
+        N=len(cells),
+        q_i=cells // data['J'] + 1,
+        p_j=cells % data['J'] + 1,
+        trials=trials,
+        y=y.astype(int),
+    )
+
+def variables(ids):
+    documents = ids['document_id'].to_list()
+    author_models = map('/'.join, ids['author_model_id'].to_list())
+
+    return {
+        'document': dict(enumerate(documents, 1)),
+        'author_model': dict(enumerate(author_models, 1)),
+    }
+
+#
+#
+#
+if __name__ == '__main__':
+    arguments = ArgumentParser()
+    arguments.add_argument('--data-file', type=Path)
+    arguments.add_argument('--ids', type=Path)
+    arguments.add_argument('--stan', type=Path)
+    arguments.add_argument('--variables', type=Path)
+    arguments.add_argument('--npz', type=Path)
+    arguments.add_argument('--compress', action='store_true')
+    arguments.add_argument('--threads', type=int)
+    arguments.add_argument('--chunksize', type=int, default=int(1e5))
+    args = arguments.parse_args()
+
+    df = pd.read_csv(
+        args.data_file,
+        dtype={
+            'author': str,
+            'model': str,
+            'document': str,
+            'score': float,
+        },
+        keep_default_na=False,
+    )
+    Logger.info('%s: %d observations', args.data_file, len(df))
+
+    score = df['score'].to_numpy()
+    if not np.all(np.mod(score, 1) == 0):
+        raise TypeError(f'[ {args.data_file} ] Non-integer scores')
+
+    ids = VariableIds(args.ids)
+    df = ids(df)
+
+    data = {
+        'I': len(ids['document_id']),                    # questions
+        'J': len(ids['author_model_id']),                # persons
+        'N': len(df),                                    # observations
+        'q_i': df['document_id'].to_numpy(),             # question for n
+        'p_j': df['author_model_id'].to_numpy(),         # person for n
+        'y': score.astype(int),                          # correctness for n
+    }
+    if args.compress:
+        data = compress(data)
+    if args.threads is not None:
+        # a few slices per thread: enough for the scheduler to balance
+        # uneven slices without paying per-slice overhead on tiny ones
+        slices = 4 * args.threads
+        data['grainsize'] = max(1, -(-data['N'] // slices))
+
+    with args.stan.open('w') as fp:
+        StanWriter(args.chunksize)(fp, data)
+    with args.variables.open('w') as fp:
+        print(json.dumps(variables(ids), indent=2), file=fp)
+    if args.npz is not None:
+        np.savez_compressed(args.npz, **data)
+
+    ids.save()
@@ -0,0 +1,502 @@
+import os
+import json
+import shutil
+import hashlib
+import subprocess
+import itertools as it
+from pathlib import Path
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+from mylib import Logger, Convergence
+
+#
+# Compiled models, cached by source hash so that each variant is built
+# once no matter how many experiments (or invocations) use it
+#
+class ModelBuild:
+    def __init__(self, cmdstan, root):
+        self.cmdstan = cmdstan
+        self.root = root
+
+    def __call__(self, source):
+        digest = hashlib.sha256(source.read_bytes()).hexdigest()
+        exe = self.root.joinpath(f'{source.stem}-{digest[:16]}')
+        if exe.exists():
+            Logger.info('%s: cached %s', source.name, exe.name)
+            return exe
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source, exe.with_suffix('.stan'))
+        Logger.info('%s: building %s', source.name, exe.name)
+        subprocess.run(
+            [
+                'make',
+                f'--jobs={os.cpu_count()}',
+                'STAN_THREADS=true',
+                str(exe.resolve()),
+            ],
+            cwd=self.cmdstan,
+            check=True,
+        )
+
+        return exe
+
+#
+# Step size and diagonal inverse metric found during warmup, as
+# recorded in the comments of a CmdStan output file
+#
+def adaptation(path):
+    with path.open() as fp:
+        for line in fp:
+            if line.startswith('# Step size'):
+                (*_, stepsize) = line.split('=')
+                next(fp) # Diagonal elements of inverse mass matrix
+                metric = next(fp).lstrip('# ').split(',')
+                return (float(stepsize), list(map(float, metric)))
+
+    raise ValueError(f'{path}: no adaptation')
+
+def parameters(path):
+    df = pd.read_csv(path, comment='#')
+    return df[list(Chain.parameters(df.columns))]
+
+#
+# A chain is sampled in segments, each its own CmdStan run, that are
+# merged into a single output file once the experiment stops
+#
+@dataclass(frozen=True)
+class Chain:
+    root: Path
+    chain: int
+    cost: float
+
+    _parameters = ('alpha', 'beta', 'theta')
+
+    @property
+    def output(self):
+        return self.root.joinpath('output')
+
+    @property
+    def target(self):
+        return self.output.joinpath(f'chain_{self.chain}.csv')
+
+    @property
+    def segments(self):
+        return self.root.joinpath('segments', f'chain_{self.chain}')
+
+    @classmethod
+    def parameters(cls, columns):
+        for c in columns:
+            if c.split('.')[0] in cls._parameters:
+                yield c
+
+    def segment(self, index):
+        return self.segments.joinpath(f'{index:03d}.csv')
+
+    def completed(self):
+        return len(list(self.segments.glob('*.csv')))
+
+    def done(self):
+        return self.target.exists()
+
+    def draws(self):
+        frames = map(parameters, sorted(self.segments.glob('*.csv')))
+        return pd.concat(frames, ignore_index=True)
+
+    @property
+    def warm(self):
+        return self.root.joinpath('previous', f'warm_{self.chain}.json')
+
+    # final draw of the most recent segment, as CmdStan inits
+    def last(self):
+        draw = parameters(self.segment(self.completed() - 1)).iloc[-1]
+
+        inits = {}
+        for (c, value) in draw.items():
+            (name, _) = c.split('.')
+            inits.setdefault(name, []).append(float(value))
+
+        return inits
+
+    def merge(self):
+        self.output.mkdir(exist_ok=True)
+        # from-stan.py expects nothing but chain CSVs in output/
+        tmp = self.target.with_name(f'.{self.target.stem}.tmp')
+        try:
+            with tmp.open('w') as fp:
+                segments = sorted(self.segments.glob('*.csv'))
+                for (i, path) in enumerate(segments):
+                    with path.open() as src:
+                        if i:
+                            lines = (x for x in src if not x.startswith('#'))
+                            next(lines) # header
+                            fp.writelines(lines)
+                        else:
+                            shutil.copyfileobj(src, fp)
+            tmp.replace(self.target)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+class Experiment:
+    _summary = 'summary.csv'
+
+    def __init__(self, root, chains):
+        self.root = root
+        self.cost = self.estimate()
+        self.chains = [
+            Chain(root, x, self.cost) for x in range(1, chains + 1)
+        ]
+
+    def __str__(self):
+        return str(self.root)
+
+    # N, I and J are the first entries of both the npz and the Stan
+    # data; prefer the npz since it can be read without parsing y
+    def size(self):
+        npz = self.root.joinpath('data.npz')
+        if npz.exists():
+            with np.load(npz) as data:
+                return tuple(int(data[x]) for x in 'NIJ')
+
+        data = json.loads(self.root.joinpath('stan.json').read_text())
+        return tuple(data[x] for x in 'NIJ')
+
+    # Each gradient is linear in N; NUTS trajectories grow roughly
+    # with the fourth root of the number of parameters
+    def estimate(self):
+        (N, I, J) = self.size()
+        return N * (2 * I + J) ** 0.25
+
+    @property
+    def previous(self):
+        return self.root.joinpath('previous')
+
+    def done(self):
+        return self.root.joinpath(self._summary).exists()
+
+    # the data has been regenerated since the last fit
+    def stale(self):
+        summary = self.root.joinpath(self._summary)
+        if not summary.exists():
+            return False
+        stan = self.root.joinpath('stan.json')
+
+        return summary.stat().st_mtime < stan.stat().st_mtime
+
+    # partial sampling (segments, or chains merged before a summary
+    # was made) from data that has since been regenerated
+    def interrupted(self):
+        stan = self.root.joinpath('stan.json').stat().st_mtime
+        paths = it.chain(
+            self.root.joinpath('segments').glob('*/*.csv'),
+            (x.target for x in self.chains if x.done()),
+        )
+
+        return any(x.stat().st_mtime < stan for x in paths)
+
+    def discard(self):
+        shutil.rmtree(self.root.joinpath('segments'), ignore_errors=True)
+        for c in self.chains:
+            c.target.unlink(missing_ok=True)
+
+    # set the last fit aside, where a refit can start from it
+    def retire(self):
+        shutil.rmtree(self.previous, ignore_errors=True)
+        self.root.joinpath('output').rename(self.previous)
+        self.root.joinpath(self._summary).unlink()
+        shutil.rmtree(self.root.joinpath('segments'), ignore_errors=True)
+
+    #
+    # Inits and adaptation for a refit. IDs are append-only across
+    # refreshes (see VariableIds), so entity k of the previous fit is
+    # entity k here and anything beyond the old length is new: new
+    # entities start from the centre of their prior, and their metric
+    # entries from the average of their block.
+    #
+    def warm(self, prior):
+        chains = sorted(self.previous.glob('chain_*.csv'))
+        means = pd.concat(map(parameters, chains)).mean()
+
+        (_, I, J) = self.size()
+        sizes = {'alpha': I, 'beta': I, 'theta': J}
+        (inits, blocks) = ({}, {})
+        for (name, n) in sizes.items():
+            old = means.filter(regex=rf'^{name}\.').to_list()
+            if len(old) > n:
+                raise ValueError(f'{self}: {name} shrank since the last fit')
+            inits[name] = old + [prior[name]] * (n - len(old))
+            blocks[name] = len(old)
+        self.previous.joinpath('init.json').write_text(json.dumps(inits))
+
+        for c in self.chains:
+            path = self.previous.joinpath(c.target.name)
+            if not path.exists():
+                path = chains[0]
+            (stepsize, metric) = adaptation(path)
+
+            extended = []
+            for (name, n) in sizes.items():
+                view = metric[:blocks[name]]
+                metric = metric[blocks[name]:]
+                extended.extend(view + [np.mean(view)] * (n - len(view)))
+            c.warm.write_text(json.dumps({
+                'stepsize': stepsize,
+                'inv_metric': extended,
+            }))
+
+    def draws(self):
+        frames = [x.draws() for x in self.chains]
+        return np.stack([x.to_numpy(dtype=np.float32) for x in frames])
+
+    def finish(self):
+        for c in self.chains:
+            c.merge()
+        shutil.rmtree(self.root.joinpath('segments'))
+        shutil.rmtree(self.previous, ignore_errors=True)
+        self.summarise()
+
+    def summarise(self):
+        summary = self.root.joinpath(self._summary)
+        subprocess.run(
+            [
+                'stansummary',
+                f'--csv_filename={summary}',
+                *(str(x.target) for x in self.chains),
+            ],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+#
+#
+#
+class Sampler:
+    def __init__(self, exe, args):
+        self.exe = exe
+        self.args = args
+
+    def samples(self, index):
+        return min(self.args.segment,
+                   self.args.samples - index * self.args.segment)
+
+    def __call__(self, chain, index):
+        chain.segments.mkdir(parents=True, exist_ok=True)
+        target = chain.segment(index)
+        tmp = target.with_name(f'.{target.stem}.tmp')
+
+        cmd = [
+            str(self.exe.resolve()),
+            f'id={chain.chain}',
+            f'num_threads={self.args.threads_per_chain}',
+        ]
+        if index:
+            # continue where the previous segment stopped, with the
+            # adaptation from warmup held fixed
+            (stepsize, metric) = adaptation(chain.segment(0))
+            metric_file = chain.segments.joinpath('metric.json')
+            metric_file.write_text(json.dumps({'inv_metric': metric}))
+            init = chain.segments.joinpath('init.json')
+            init.write_text(json.dumps(chain.last()))
+
+            cmd.extend((
+                f'init={init}',
+                'sample',
+                f'num_samples={self.samples(index)}',
+                'num_warmup=0',
+                'algorithm=hmc',
+                f'metric_file={metric_file}',
+                f'stepsize={stepsize}',
+                'adapt',
+                'engaged=0',
+            ))
+        elif self.args.refit and chain.warm.exists():
+            # start from the previous fit: its posterior means and
+            # adaptation. The metric is kept as is; warmup only
+            # re-tunes the step size, since an initial buffer spanning
+            # all of it leaves no slow window to re-estimate the metric
+            warm = json.loads(chain.warm.read_text())
+            metric_file = chain.segments.joinpath('metric.json')
+            metric_file.write_text(json.dumps({
+                'inv_metric': warm['inv_metric'],
+            }))
+            init = chain.warm.with_name('init.json')
+
+            cmd.extend((
+                f'init={init}',
+                'sample',
+                f'num_samples={self.samples(index)}',
+                f'num_warmup={self.args.refit_warmup}',
+                'algorithm=hmc',
+                f'metric_file={metric_file}',
+                f'stepsize={warm["stepsize"]}',
+                'adapt',
+                f'init_buffer={self.args.refit_warmup}',
+                'term_buffer=0',
+                'window=0',
+            ))
+        else:
+            cmd.extend((
+                'sample',
+                f'num_samples={self.samples(index)}',
+                f'num_warmup={self.args.warmup}',
+            ))
+        cmd.extend((
+            'data',
+            f'file={chain.root.joinpath("stan.json")}',
+            'output',
+            f'file={tmp}',
+            'random',
+            f'seed={self.args.seed + index}',
+        ))
+
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+            tmp.replace(target)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+#
+# Runs every chain of an experiment a segment at a time. Once all of
+# its chains have the same number of segments the experiment is either
+# finished (draw cap reached or convergence targets met) or given
+# another segment.
+#
+class Scheduler:
+    def __init__(self, executor, sampler, convergence, args):
+        self.executor = executor
+        self.sampler = sampler
+        self.convergence = convergence
+        self.args = args
+        self.running = {}
+
+    def __call__(self, experiments):
+        #
+        # Longest-processing-time first: with chains queued by
+        # decreasing cost, handing each free slot the next chain
+        # keeps the tail short
+        #
+        for e in sorted(experiments, key=lambda x: x.cost, reverse=True):
+            self.advance(e)
+
+        while self.running:
+            (done, _) = wait(self.running, return_when=FIRST_COMPLETED)
+            for f in done:
+                (e, c, index) = self.running.pop(f)
+                f.result()
+                Logger.info('%s: chain %d segment %d', e, c.chain, index)
+                if not any(x is e for (x, *_) in self.running.values()):
+                    self.advance(e)
+
+    def submit(self, experiment, chain, index):
+        future = self.executor.submit(self.sampler, chain, index)
+        self.running[future] = (experiment, chain, index)
+
+    def advance(self, experiment):
+        if all(x.done() for x in experiment.chains):
+            experiment.summarise()
+            return
+
+        completed = [x.completed() for x in experiment.chains]
+        n = max(completed)
+        lagging = [x for (x, y) in zip(experiment.chains, completed) if y < n]
+        if lagging or not n:
+            for (c, index) in zip(experiment.chains, completed):
+                if index < n or not n:
+                    self.submit(experiment, c, index)
+        elif self.stop(experiment, n):
+            experiment.finish()
+        else:
+            for c in experiment.chains:
+                self.submit(experiment, c, n)
+
+    def stop(self, experiment, segments):
+        drawn = min(segments * self.args.segment, self.args.samples)
+        if drawn >= self.args.samples:
+            return True
+
+        measured = self.convergence.measure(experiment.draws())
+        Logger.info(
+            '%s: %d draws, R-hat %.3f, bulk ESS %.0f, tail ESS %.0f',
+            experiment,
+            drawn,
+            measured['rhat'],
+            measured['ess_bulk'],
+            measured['ess_tail'],
+        )
+
+        return self.convergence.met(measured)
+
+#
+#
+#
+if __name__ == '__main__':
+    arguments = ArgumentParser()
+    arguments.add_argument('--experiments', type=Path)
+    arguments.add_argument('--model', type=Path)
+    arguments.add_argument('--build-cache', type=Path)
+    arguments.add_argument('--cmdstan', type=Path,
+                           default=os.environ.get('CMDSTAN'))
+    arguments.add_argument('--chains', type=int, default=4)
+    arguments.add_argument('--samples', type=int, default=1000)
+    arguments.add_argument('--warmup', type=int, default=1000)
+    arguments.add_argument('--segment', type=int)
+    arguments.add_argument('--refit', action='store_true')
+    arguments.add_argument('--refit-warmup', type=int, default=150)
+    arguments.add_argument('--rhat', type=float, default=1.01)
+    arguments.add_argument('--ess-bulk', type=float, default=400)
+    arguments.add_argument('--ess-tail', type=float, default=400)
+    arguments.add_argument('--seed', type=int, default=1234)
+    arguments.add_argument('--threads-per-chain', type=int, default=1)
+    arguments.add_argument('--cores', type=int, default=os.cpu_count())
+    args = arguments.parse_args()
+    if args.segment is None:
+        args.segment = args.samples
+
+    # centre of each prior in model.stan
+    prior = {
+        'alpha': float(np.exp(0.5)),
+        'beta': 0.0,
+        'theta': 0.0,
+    }
+
+    # experiments sit at any depth below the root (step 2 writes them
+    # to <benchmark>/<name>/), each marked by its Stan data
+    roots = sorted(x.parent for x in args.experiments.rglob('stan.json'))
+    if not roots:
+        raise FileNotFoundError(f'{args.experiments}: no experiments')
+
+    experiments = []
+    for d in roots:
+        e = Experiment(d, args.chains)
+        if e.stale():
+            Logger.info('%s: data changed since last fit', e)
+            e.retire()
+        if e.done():
+            Logger.info('%s: complete', e)
+            continue
+        if e.interrupted():
+            Logger.info('%s: discarding partial run on old data', e)
+            e.discard()
+
+        if args.refit and e.previous.exists():
+            stan = d.joinpath('stan.json').stat().st_mtime
+            warm = (x.warm for x in e.chains)
+            if not all(x.exists() and x.stat().st_mtime >= stan for x in warm):
+                e.warm(prior)
+            Logger.info('%s: refit', e)
+        experiments.append(e)
+
+    exe = ModelBuild(args.cmdstan, args.build_cache)(args.model)
+    sampler = Sampler(exe, args)
+    convergence = Convergence(args.rhat, args.ess_bulk, args.ess_tail)
+    slots = max(1, args.cores // args.threads_per_chain)
+    Logger.info('%d experiments, %d slots', len(experiments), slots)
+
+    with ThreadPoolExecutor(max_workers=slots) as executor:
+        scheduler = Scheduler(executor, sampler, convergence, args)
+        scheduler(experiments)